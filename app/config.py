@@ -7,11 +7,19 @@ class Settings(BaseModel):
     openai_chat_model: str = os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini")
 
     db_url: str = os.getenv("IVESNA_DB_URL", "sqlite:///./ivesna.db")
+    index_dir: str = os.getenv("IVESNA_INDEX_DIR", "./ivesna_index")
     allowed_domains: list[str] = os.getenv("IVESNA_ALLOWED_DOMAINS", "slsp.sk,www.slsp.sk").split(",")
+    # hosts whose pages need JS rendering (Playwright); others are fetched over plain HTTP
+    js_domains: list[str] = [d for d in os.getenv("IVESNA_JS_DOMAINS", "slsp.sk,www.slsp.sk").split(",") if d]
+    # tenants whose sites are crawled at a fixed, known-polite rate instead of AutoThrottle
+    trusted_tenants: list[str] = [t for t in os.getenv("IVESNA_TRUSTED_TENANTS", "slsp").split(",") if t]
     tenant_name: str = os.getenv("IVESNA_TENANT_NAME", "Slovenská sporiteľňa")
 
     max_chunk_tokens: int = int(os.getenv("MAX_CHUNK_TOKENS", 900))
     chunk_overlap_tokens: int = int(os.getenv("CHUNK_OVERLAP_TOKENS", 120))
     top_k: int = int(os.getenv("TOP_K", 6))
 
+    embed_batch_size: int = int(os.getenv("EMBED_BATCH_SIZE", 64))
+    embed_concurrency: int = int(os.getenv("EMBED_CONCURRENCY", 8))
+
 settings = Settings()
\ No newline at end of file
@@ -1,70 +1,90 @@
 # app/crawler.py
 from __future__ import annotations
-from typing import List, Optional
+from functools import lru_cache
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple, Union
 from urllib.parse import urlparse
 import re
-import xml.etree.ElementTree as ET
 
 import requests
+from lxml import etree
 import scrapy
 from scrapy.crawler import CrawlerProcess
 from scrapy.linkextractors import LinkExtractor
 from scrapy.spiders import CrawlSpider, Rule
 from scrapy.utils.project import get_project_settings
 from scrapy import signals
+from scrapy.exceptions import CloseSpider
 from scrapy_playwright.page import PageMethod
 
 from tqdm import tqdm
 
 from .config import settings
 
-ALLOWED_DOMAINS = set(settings.allowed_domains)
+ALLOWED_DOMAINS = tuple(dict.fromkeys(settings.allowed_domains))
+_ALLOWED_EXACT = frozenset(ALLOWED_DOMAINS)
 
 # ------------------ helpers ------------------
 
+@lru_cache(maxsize=8192)
 def allowed(url: str) -> bool:
     try:
         netloc = urlparse(url).netloc.lower()
-        return any(netloc.endswith(d) for d in ALLOWED_DOMAINS)
     except Exception:
         return False
+    return netloc in _ALLOWED_EXACT or netloc.endswith(ALLOWED_DOMAINS)
+
+def allow_domains(urls: Sequence[str]) -> List[str]:
+    """Hosts the crawl may visit: those of the seed URLs plus the configured ones."""
+    return list({urlparse(u).netloc for u in urls} | _ALLOWED_EXACT)
+
+_CONTENT_TAGS = ("main", "article", "section", "p", "li", "td", "th", "h1", "h2", "h3")
+_TEXT_NODES_XPATH = etree.XPath(".//text()", smart_strings=False)
+_BODY_TEXT_XPATH = etree.XPath("//body//text()", smart_strings=False)
+_WS_RE = re.compile(r"\s+")
+
+def _iter_content_text(root) -> Iterator[str]:
+    """
+    Single DOM pass: yield text nodes of the outermost semantic containers in
+    document order. Nested containers are skipped, so nothing is emitted twice.
+    """
+    walker = etree.iterwalk(root, events=("start",), tag=_CONTENT_TAGS)
+    for _, elem in walker:
+        yield from _TEXT_NODES_XPATH(elem)
+        walker.skip_subtree()
 
 def _extract_text(response: scrapy.http.Response) -> str:
     """
     Class-agnostic extraction using semantic tags; falls back to body text.
     """
-    sel = response.selector
-    parts = sel.xpath(
-        """
-        //main//text() |
-        //article//text() |
-        //section//text() |
-        //p//text() |
-        //li//text() |
-        //td//text() | //th//text() |
-        //h1//text() | //h2//text() | //h3//text()
-        """
-    ).getall()
+    root = response.selector.root
+    parts = list(_iter_content_text(root))
     if not parts:
-        parts = sel.xpath("//body//text()").getall()
-    text = " ".join(" ".join(t.split()) for t in parts if t and t.strip())
-    return text
+        parts = _BODY_TEXT_XPATH(root)
+    return _WS_RE.sub(" ", " ".join(parts)).strip()
 
 def _short(s: str, n: int = 60) -> str:
     return s if len(s) <= n else s[: n - 1] + "…"
 
-def _compile_allow(patterns: Optional[List[str]], domains: List[str]) -> Optional[List[re.Pattern]]:
+AllowPattern = Union[str, re.Pattern]
+
+@lru_cache(maxsize=64)
+def _compile_allow(patterns: Tuple[AllowPattern, ...], domains: Tuple[str, ...]) -> Optional[Tuple[re.Pattern, ...]]:
     """
     Make user-supplied allow patterns robust:
     - '^/path.*' -> matches both https://slsp.sk/path and https://www.slsp.sk/path
     - raw substrings -> treated as 'contains' on same hosts
     - full '^https?://...' kept as-is
+    - already compiled patterns (output of a previous call) pass through unchanged
+    Cached; call through compile_allow() so list arguments become hashable keys.
     """
     if not patterns:
         return None
     compiled: List[re.Pattern] = []
     host_alt = "|".join(re.escape(d) for d in domains) or r"(?:slsp\.sk|www\.slsp\.sk)"
     for p in patterns:
+        if isinstance(p, re.Pattern):
+            compiled.append(p)
+            continue
         if not p:
             continue
         p = p.strip()
@@ -76,25 +96,41 @@ def _compile_allow(patterns: Optional[List[str]], domains: List[str]) -> Optiona
         else:
             rx = rf"^https?://(?:{host_alt})/.+{re.escape(p)}"
             compiled.append(re.compile(rx))
-    return compiled or None
+    return tuple(compiled) or None
 
-def sitemap_seed(root: str, allow_patterns: List[str], domains: List[str]) -> List[str]:
+def compile_allow(patterns: Optional[Sequence[AllowPattern]], domains: Sequence[str]) -> Optional[Tuple[re.Pattern, ...]]:
+    return _compile_allow(tuple(patterns or ()), tuple(sorted(domains)))
+
+def _iter_sitemap(root: str, rx_list: Sequence[re.Pattern]) -> Iterator[str]:
     """
-    Pull /sitemap.xml and return URLs matching compiled allow rules.
-    Best-effort; ignored on errors.
+    Stream /sitemap.xml through lxml's iterparse and yield matching <loc> URLs,
+    dropping processed elements so memory stays flat on large sitemaps.
     """
-    seeds: List[str] = []
-    try:
-        r = requests.get(root.rstrip("/") + "/sitemap.xml", timeout=15)
+    with requests.get(root.rstrip("/") + "/sitemap.xml", timeout=15, stream=True) as r:
         r.raise_for_status()
-        rx_list = _compile_allow(allow_patterns, domains) or []
-        xml_root = ET.fromstring(r.text)
-        for loc in xml_root.findall(".//{*}loc"):
+        r.raw.decode_content = True
+        # untrusted XML: never expand entities or fetch external resources (lxml < 5 resolves by default)
+        for _, loc in etree.iterparse(r.raw, events=("end",), tag="{*}loc", resolve_entities=False, no_network=True):
             u = (loc.text or "").strip()
+            loc.clear()
+            entry = loc.getparent()  # <url> / <sitemap>
+            if entry is not None:
+                while entry.getprevious() is not None:
+                    del entry.getparent()[0]
             if not u or not allowed(u):
                 continue
             if not rx_list or any(rx.search(u) for rx in rx_list):
-                seeds.append(u)
+                yield u
+
+def sitemap_seed(root: str, rx_list: Sequence[re.Pattern]) -> List[str]:
+    """
+    Pull /sitemap.xml and return URLs matching precompiled allow rules.
+    Best-effort; ignored on errors.
+    """
+    seeds: List[str] = []
+    try:
+        for u in _iter_sitemap(root, rx_list):
+            seeds.append(u)
     except Exception:
         pass
     return seeds
@@ -132,12 +168,65 @@ PLAYWRIGHT_METHODS = [
         }
         """,
     ),
-    PageMethod("wait_for_load_state", "networkidle"),
-    PageMethod("wait_for_timeout", 300),
+    PageMethod("wait_for_load_state", "load"),
+    # Continue as soon as semantic content is in the DOM; give up waiting after 5 s
+    # (resolves instead of throwing, so pages without these tags are still parsed).
+    PageMethod(
+        "evaluate",
+        """
+        () => new Promise(resolve => {
+          const ready = () => document.querySelector('main, article, section');
+          if (ready()) return resolve();
+          const obs = new MutationObserver(() => { if (ready()) { obs.disconnect(); resolve(); } });
+          obs.observe(document.documentElement, { childList: true, subtree: true });
+          setTimeout(() => { obs.disconnect(); resolve(); }, 5000);
+        })
+        """,
+    ),
 ]
 
+# Media/fonts are never used for text extraction; don't download them.
+_MEDIA_GLOB = "**/*.{png,jpg,jpeg,gif,svg,webp,ico,woff,woff2,ttf,eot,mp4,webm}"
+
+async def _abort_route(route):
+    await route.abort()
+
+async def _block_media(page, request):
+    """Page init callback: runs before navigation, so routes apply to the initial load."""
+    await page.route(_MEDIA_GLOB, _abort_route)
+
+# Paths served as static HTML/documents: fetch over plain HTTP instead of a browser.
+_STATIC_PATH_RE = re.compile(r"/content/dam/|/archiv|/landing-pages/|/zmluvne-podmienky|\.pdf$", re.IGNORECASE)
+
+_JS_DOMAINS = tuple(dict.fromkeys(settings.js_domains))
+_JS_EXACT = frozenset(_JS_DOMAINS)
+
+def needs_js(url: str) -> bool:
+    """True when the page must be rendered in a browser: https on a JS host, path not known-static."""
+    parts = urlparse(url)
+    if parts.scheme != "https" or _STATIC_PATH_RE.search(parts.path):
+        return False
+    netloc = parts.netloc.lower()
+    return netloc in _JS_EXACT or netloc.endswith(_JS_DOMAINS)
+
 # ------------------ Spider ------------------
 
+# trusted tenants: static delay, no per-response AutoThrottle bookkeeping
+_TRUSTED_THROTTLE = {
+    "AUTOTHROTTLE_ENABLED": False,
+    "DOWNLOAD_DELAY": 0.25,
+    "CONCURRENT_REQUESTS_PER_DOMAIN": 4,
+}
+# unknown sites: adapt to the server's latency
+_AUTO_THROTTLE = {
+    "AUTOTHROTTLE_ENABLED": True,
+    "AUTOTHROTTLE_START_DELAY": 0.25,
+    "AUTOTHROTTLE_MAX_DELAY": 3.0,
+}
+
+def throttle_settings(tenant: Optional[str]) -> dict:
+    return _TRUSTED_THROTTLE if tenant in settings.trusted_tenants else _AUTO_THROTTLE
+
 class SiteCrawler(CrawlSpider):
     name = "site_crawler"
 
@@ -146,15 +235,16 @@ class SiteCrawler(CrawlSpider):
         start_urls: List[str],
         max_pages: int = 200,
         max_depth: int = 3,
-        allow_patterns: Optional[List[str]] = None,
+        allow_patterns: Optional[Sequence[AllowPattern]] = None,
         ignore_robots: bool = False,
+        tenant: Optional[str] = None,
         *args, **kwargs,
     ):
         super().__init__(*args, **kwargs)
         self.start_urls = [u for u in start_urls if allowed(u)]
-        self.allowed_domains = list({urlparse(u).netloc for u in self.start_urls} | ALLOWED_DOMAINS)
+        self.allowed_domains = allow_domains(self.start_urls)
         self.allow_patterns = allow_patterns or []
-        self._allow_regex = _compile_allow(self.allow_patterns, self.allowed_domains)
+        self._allow_regex = compile_allow(self.allow_patterns, self.allowed_domains)
         self.results: List[dict] = []
 
         self.custom_settings = {
@@ -163,6 +253,7 @@ class SiteCrawler(CrawlSpider):
             "DEPTH_LIMIT": int(max_depth),
             "LOG_ENABLED": False,
             "CLOSESPIDER_TIMEOUT": 240,
+            **throttle_settings(tenant),
         }
 
         self.rules = (
@@ -185,9 +276,20 @@ class SiteCrawler(CrawlSpider):
         )
         super()._compile_rules()
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        # Scrapy only reads the class-level custom_settings; ours depend on the
+        # crawl arguments, so apply them before the crawler freezes its settings.
+        crawler.settings.setdict(spider.custom_settings, priority="spider")
+        return spider
+
     def use_playwright(self, request, response=None):
+        if not needs_js(request.url):
+            return request
         request.meta["playwright"] = True
         request.meta["playwright_page_methods"] = PLAYWRIGHT_METHODS
+        request.meta["playwright_page_init_callback"] = _block_media
         request.meta["playwright_context_kwargs"] = {"locale": "sk-SK"}
         return request
 
@@ -236,23 +338,31 @@ def crawl_urls_blocking(
     urls: List[str],
     max_pages: int = 200,
     max_depth: int = 3,
-    allow_patterns: Optional[List[str]] = None,
+    allow_patterns: Optional[Sequence[AllowPattern]] = None,
     ignore_robots: bool = False,
+    on_page: Optional[Callable[[dict], bool]] = None,
+    tenant: Optional[str] = None,
 ) -> List[dict]:
     """
     Run crawler synchronously; show tqdm progress (advances when a page is parsed).
     Also seeds from sitemap.xml for each start URL if allow_patterns are provided.
+    allow_patterns may be raw strings or the output of compile_allow().
+    on_page(page) is called from the reactor thread as each page is parsed, so
+    pages can be processed while the crawl is still running; it must not block.
+    A falsy return from on_page closes the spider (e.g. the consumer failed).
+    tenant selects the throttling policy (see throttle_settings).
     """
     settings_obj = get_project_settings()
     process = CrawlerProcess(settings=settings_obj)
 
     # sitemap seeding using host-agnostic compiled rules
-    domains = list({urlparse(u).netloc for u in urls} | ALLOWED_DOMAINS)
+    domains = allow_domains(urls)
     seed_urls = list({*urls})
     if allow_patterns:
+        rx_list = compile_allow(allow_patterns, domains) or ()
         extra: List[str] = []
         for u in urls:
-            extra += sitemap_seed(u, allow_patterns, domains)
+            extra += sitemap_seed(u, rx_list)
         seed_urls = list({*seed_urls, *extra})
 
     results_container = {"items": []}
@@ -282,6 +392,8 @@ def crawl_urls_blocking(
         if after > before:
             page = self.results[-1]
             crawler.signals.send_catch_log(PAGE_PARSED, spider=self, url=page["url"], title=page["title"])
+            if on_page is not None and not on_page(page):
+                raise CloseSpider("on_page")
         return res
     SiteCrawler.parse_page = wrapped_parse_page  # type: ignore
 
@@ -292,6 +404,7 @@ def crawl_urls_blocking(
         max_depth=max_depth,
         allow_patterns=allow_patterns,
         ignore_robots=ignore_robots,
+        tenant=tenant,
     )
     process.start()  # blocks until done
     return results_container["items"]
@@ -1,5 +1,9 @@
-from sqlalchemy import create_engine, Integer, String, Text, ForeignKey, Float, DateTime
-from sqlalchemy.orm import sessionmaker, DeclarativeBase, Mapped, mapped_column, relationship
+import json
+import uuid
+
+import numpy as np
+from sqlalchemy import create_engine, Integer, String, Text, LargeBinary, ForeignKey, Float, DateTime, text
+from sqlalchemy.orm import Session, sessionmaker, DeclarativeBase, Mapped, mapped_column, relationship
 from sqlalchemy.sql import func
 from sqlalchemy import event
 
@@ -20,6 +24,7 @@ def _set_sqlite_pragma(dbapi_connection, connection_record):
         cursor.execute("PRAGMA journal_mode=WAL;")
         cursor.execute("PRAGMA synchronous=NORMAL;")
         cursor.execute("PRAGMA busy_timeout=30000;")  # 30s
+        cursor.execute("PRAGMA mmap_size=268435456;")  # 256 MiB: page BLOB-heavy reads via mmap
         cursor.close()
     except Exception:
         pass
@@ -44,11 +49,63 @@ class Chunk(Base):
     tenant: Mapped[str] = mapped_column(String(64), index=True)
     ordinal: Mapped[int] = mapped_column(Integer)
     text: Mapped[str] = mapped_column(Text)
-    embedding: Mapped[str] = mapped_column(Text)  # JSON-encoded list[float]
+    embedding: Mapped[bytes] = mapped_column(LargeBinary)  # raw float32 bytes
     score: Mapped[float] = mapped_column(Float, default=0.0)
 
     document: Mapped[Document] = relationship(back_populates="chunks")
 
+class IndexGeneration(Base):
+    """Random token replaced on every ingest commit; tags persisted retrieval indexes."""
+    __tablename__ = "index_generations"
+    tenant: Mapped[str] = mapped_column(String(64), primary_key=True)
+    generation: Mapped[str] = mapped_column(String(32))
+
+def bump_index_generation(db: Session, tenant: str) -> None:
+    """Mark the tenant's chunks as changed; call inside the transaction that changes them."""
+    db.merge(IndexGeneration(tenant=tenant, generation=uuid.uuid4().hex))
+
 
 def init_db():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+    migrate_json_embeddings()
+    backfill_index_generations()
+
+
+# legacy rows converted per transaction; bounds memory on large corpora
+_MIGRATE_BATCH_ROWS = 1000
+
+def migrate_json_embeddings() -> int:
+    """
+    One-shot migration: rewrite legacy JSON-encoded embeddings as raw float32 bytes,
+    in keyset batches over id. No-op once every row holds a BLOB.
+    """
+    migrated, last_id = 0, 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT id, embedding FROM chunks WHERE id > :last AND typeof(embedding) = 'text' "
+                    "ORDER BY id LIMIT :n"
+                ),
+                {"last": last_id, "n": _MIGRATE_BATCH_ROWS},
+            ).all()
+            if not rows:
+                return migrated
+            conn.execute(
+                text("UPDATE chunks SET embedding = :emb WHERE id = :id"),
+                [
+                    {"id": cid, "emb": np.asarray(json.loads(emb), dtype=np.float32).tobytes()}
+                    for cid, emb in rows
+                ],
+            )
+        migrated += len(rows)
+        last_id = rows[-1][0]
+
+def backfill_index_generations() -> None:
+    """Give tenants ingested before generations existed one, so their index can be persisted."""
+    with engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO index_generations (tenant, generation) "
+            "SELECT tenant, lower(hex(randomblob(16))) FROM (SELECT DISTINCT tenant FROM chunks) "
+            "WHERE tenant NOT IN (SELECT tenant FROM index_generations)"
+        ))
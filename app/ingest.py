@@ -9,6 +9,6 @@ def ingest_urls(db: Session, tenant: str, urls: List[str]) -> dict:
     urls = [u for u in urls if allowed(u)]
     if not urls:
         return {"documents": 0}
-    pages = crawl_urls_blocking(urls)
+    pages = crawl_urls_blocking(urls, tenant=tenant)
     stored = process_pages(db, tenant, pages)
     return {"documents": stored}
\ No newline at end of file
@@ -1,34 +1,215 @@
-import json
+import queue
+import threading
+from typing import Callable, Iterable, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 from tqdm import tqdm
 
-from .db import Document, Chunk
-from .openai_client import embed_texts
+from .db import Document, Chunk, SessionLocal, bump_index_generation
+from .openai_client import embed_texts_batched
+from .retrieval import embedding_matrix
 from .utils import chunk_text
 from .config import settings
 
+# pages written per transaction; WAL makes each commit cheap, but not free
+COMMIT_EVERY_PAGES = 20
+# max items buffered between pipeline stages
+PIPELINE_QUEUE_SIZE = 4
+# chunk rows per executemany; rows are buffered across pages up to this size
+INSERT_BATCH_ROWS = 500
+# how often a blocked stage re-checks whether the pipeline was stopped
+_STAGE_POLL_SECONDS = 0.1
+
+_DONE = object()
+
+class _Stopped(Exception):
+    """Raised inside a stage once the pipeline's consumer has gone away."""
+
 def _short(s: str, n: int = 70) -> str:
     return s if len(s) <= n else s[: n-1] + "…"
 
-def process_pages(db: Session, tenant: str, pages: list[dict]) -> int:
-    stored = 0
-    proc = tqdm(pages, desc="Processing", unit="page")
-    for page in proc:
+def _put(q: queue.Queue, item, stop: threading.Event) -> None:
+    """Blocking put that gives up (raises _Stopped) once stop is set."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=_STAGE_POLL_SECONDS)
+            return
+        except queue.Full:
+            pass
+    raise _Stopped
+
+def _drain(q: queue.Queue, stop: threading.Event):
+    while True:
+        if stop.is_set():
+            raise _Stopped
+        try:
+            item = q.get(timeout=_STAGE_POLL_SECONDS)
+        except queue.Empty:
+            continue
+        if item is _DONE:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+def _clear(q: queue.Queue) -> None:
+    try:
+        while True:
+            q.get_nowait()
+    except queue.Empty:
+        pass
+
+def _run_stage(target, out_q: queue.Queue, stop: threading.Event, *args) -> threading.Thread:
+    """
+    Run a pipeline stage in a daemon thread; errors are forwarded downstream, then _DONE.
+    Setting stop makes the stage exit instead of blocking on a queue nobody reads.
+    """
+    def run():
+        try:
+            try:
+                target(out_q, stop, *args)
+            except _Stopped:
+                raise
+            except BaseException as e:
+                _put(out_q, e, stop)
+            _put(out_q, _DONE, stop)
+        except _Stopped:
+            pass
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    return t
+
+def _chunk_stage(out_q: queue.Queue, stop: threading.Event, pages: Iterable[dict]) -> None:
+    for page in pages:
         title = page.get("title") or page.get("url") or ""
         text = (page.get("text") or "").strip()
-        proc.set_description_str(f"Processing | {_short(title)} ({len(text)} chars)")
-        if not text:
-            continue
+        chunks = []
+        if text:
+            # materialized: the embed stage batches chunks across pages
+            chunks = list(chunk_text(text, max_tokens=settings.max_chunk_tokens, overlap=settings.chunk_overlap_tokens))
+        _put(out_q, (page, title, len(text), chunks), stop)
 
-        chunks = chunk_text(text, max_tokens=settings.max_chunk_tokens, overlap=settings.chunk_overlap_tokens)
-        if not chunks:
-            continue
-        embeddings = embed_texts(chunks)
+def _embed_stage(out_q: queue.Queue, stop: threading.Event, in_q: queue.Queue) -> None:
+    # coalesce chunks across pages so each flush fills every concurrent embedding request
+    flush_at = max(1, settings.embed_batch_size * settings.embed_concurrency)
+    pending: list[tuple[dict, str, int, list[str]]] = []
+    n_pending = 0
+
+    def flush():
+        embeddings = embed_texts_batched([ch for *_, chunks in pending for ch in chunks])
+        offset = 0
+        for page, title, n_chars, chunks in pending:
+            _put(out_q, (page, title, n_chars, chunks, embeddings[offset : offset + len(chunks)]), stop)
+            offset += len(chunks)
+        pending.clear()
 
-        doc = Document(tenant=tenant, url=page.get("url"), title=title, lang="sk")
-        db.add(doc); db.flush()
-        for i, (ch, emb) in enumerate(zip(chunks, embeddings)):
-            db.add(Chunk(document_id=doc.id, tenant=tenant, ordinal=i, text=ch, embedding=json.dumps(emb)))
+    for item in _drain(in_q, stop):
+        pending.append(item)
+        n_pending += len(item[3])
+        if n_pending >= flush_at:
+            flush()
+            n_pending = 0
+    if pending:
+        flush()
+
+def process_pages(db: Session, tenant: str, pages: Iterable[dict], total: Optional[int] = None) -> int:
+    """
+    Chunk -> embed -> store, as a three-stage pipeline: chunking and embedding run
+    in worker threads while this thread writes to the DB, so CPU, network and disk overlap.
+    pages may be a lazy iterable (see stream_pages_to_db); total only sizes the progress bar.
+    """
+    if total is None and isinstance(pages, (list, tuple)):
+        total = len(pages)
+    chunked: queue.Queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    embedded: queue.Queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+    _run_stage(_chunk_stage, chunked, stop, pages)
+    _run_stage(_embed_stage, embedded, stop, chunked)
+
+    stored = 0
+    pending_rows: list[dict] = []
+
+    def flush_rows():
+        if pending_rows:
+            db.execute(insert(Chunk), pending_rows)
+            pending_rows.clear()
+
+    def commit():
+        flush_rows()
+        bump_index_generation(db, tenant)  # invalidates persisted indexes in the same transaction
         db.commit()
-        stored += 1
+
+    proc = tqdm(total=total, desc="Processing", unit="page")
+    try:
+        for page, title, n_chars, chunks, embeddings in _drain(embedded, stop):
+            proc.set_description_str(f"Processing | {_short(title)} ({n_chars} chars)")
+            proc.update(1)
+            if not chunks:
+                continue
+
+            doc = Document(tenant=tenant, url=page.get("url"), title=title, lang="sk")
+            db.add(doc); db.flush()
+            for i, (ch, emb) in enumerate(zip(chunks, embeddings)):
+                pending_rows.append({
+                    "document_id": doc.id,
+                    "tenant": tenant,
+                    "ordinal": i,
+                    "text": ch,
+                    "embedding": np.asarray(emb, dtype=np.float32).tobytes(),
+                })
+                if len(pending_rows) >= INSERT_BATCH_ROWS:
+                    flush_rows()
+            stored += 1
+            if stored % COMMIT_EVERY_PAGES == 0:
+                commit()
+        if stored % COMMIT_EVERY_PAGES:
+            commit()
+    finally:
+        # on error the stages would otherwise block forever on full queues
+        stop.set()
+        _clear(chunked)
+        _clear(embedded)
+        proc.close()
+    if stored:
+        embedding_matrix(db, tenant, rebuild=True)  # rebuild + persist the retrieval matrix now, not on first query
     return stored
+
+def stream_pages_to_db(tenant: str, total: Optional[int] = None) -> Tuple[Callable[[dict], bool], Callable[[], int]]:
+    """
+    Run process_pages on its own session in a background thread, fed page by page.
+    Returns (feed, finish): feed(page) never blocks, so it is safe to call from the
+    crawler's reactor, and returns False once the writer has failed (pages are then
+    dropped; the caller should stop crawling). finish() ends the stream, waits for
+    the writer and returns the number of stored documents (re-raising any error
+    from the writer).
+    """
+    pages_q: queue.Queue = queue.Queue()
+    result: dict = {}
+
+    def run():
+        try:
+            with SessionLocal() as db:
+                result["stored"] = process_pages(db, tenant, iter(pages_q.get, _DONE), total=total)
+        except BaseException as e:
+            result["error"] = e
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+
+    def feed(page: dict) -> bool:
+        if "error" in result:
+            _clear(pages_q)
+            return False
+        pages_q.put(page)
+        return True
+
+    def finish() -> int:
+        pages_q.put(_DONE)
+        t.join()
+        if "error" in result:
+            raise result["error"]
+        return result["stored"]
+
+    return feed, finish
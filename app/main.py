@@ -1,13 +1,12 @@
 from fastapi import Request, FastAPI, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
-from sqlalchemy import select
 import logging
 import os
 import time
 
 from .config import settings
-from .db import init_db, SessionLocal, Document
+from .db import init_db, SessionLocal
 from .models import IngestRequest, ChatRequest, ChatResponse
 from .ingest import ingest_urls
 from .retrieval import retrieve
@@ -76,19 +75,14 @@ def chat(req: ChatRequest, request: Request, db: Session = Depends(get_db)):
         return ChatResponse(answer=answer, citations=[], usage=None)
 
     # Log top hits with scores and url
-    doc_ids = [doc_id for _, _, doc_id, _ in top]
-    docs = {d.id: d for d in db.execute(select(Document).where(Document.id.in_(doc_ids))).scalars()}
-    for rank, (_, _text, doc_id, score) in enumerate(top, 1):
-        d = docs.get(doc_id)
-        logger.debug("HIT #%d score=%.4f url=%s title=%r", rank, score, getattr(d, "url", "?"), getattr(d, "title", "?"))
+    for rank, (_, _text, _doc_id, score, url, title) in enumerate(top, 1):
+        logger.debug("HIT #%d score=%.4f url=%s title=%r", rank, score, url, title)
 
     # --- Build context & citations ---
     context_lines = []
     citations = []
     seen = set()
-    for i, (_, text, doc_id, _) in enumerate(top, start=1):
-        url = docs[doc_id].url
-        title = docs[doc_id].title
+    for i, (_, text, _doc_id, _, url, title) in enumerate(top, start=1):
         snippet = (text[:750] + "…") if len(text) > 750 else text
         context_lines.append(f"[{i}] {snippet}\n({url})\n")
         if url not in seen:
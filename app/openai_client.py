@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from openai import OpenAI
 from .config import settings
 
@@ -16,6 +18,20 @@ def embed_texts(texts: list[str]) -> list[list[float]]:
     return [d.embedding for d in resp.data]
 
 
+def embed_texts_batched(texts: list[str]) -> list[list[float]]:
+    """
+    Embed many texts in fixed-size batches sent concurrently; output order matches input.
+    Batch size is kept well under the per-request token limit (~900-token chunks).
+    """
+    size = max(1, settings.embed_batch_size)
+    batches = [texts[i : i + size] for i in range(0, len(texts), size)]
+    if len(batches) <= 1:
+        return embed_texts(texts) if texts else []
+    get_client()  # create the shared (thread-safe) client before fanning out
+    with ThreadPoolExecutor(max_workers=min(settings.embed_concurrency, len(batches))) as pool:
+        return [emb for batch in pool.map(embed_texts, batches) for emb in batch]
+
+
 def chat_answer(system_prompt: str, user_prompt: str) -> tuple[str, dict]:
     client = get_client()
     resp = client.chat.completions.create(
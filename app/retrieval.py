@@ -1,85 +1,273 @@
 # app/retrieval.py
+import hashlib
 import json
-import math
+import logging
+import os
+import re
 import unicodedata
 from collections import Counter, defaultdict
+from functools import lru_cache
+from pathlib import Path
 from typing import List, Tuple, Dict
 
 import numpy as np
-from sqlalchemy import select
+from sqlalchemy import select, func
 from sqlalchemy.orm import Session
 
-from .db import Chunk, Document
+from .db import Chunk, Document, IndexGeneration
 from .openai_client import embed_texts
 from .config import settings
 
+logger = logging.getLogger("ivesna.retrieval")
+
 # ----------------- tokenization & helpers -----------------
 
-_SK_STOP = {
+_SK_STOP = frozenset({
     "a","aj","alebo","ani","na","v","vo","do","z","za","od","o","u","s","so",
     "je","sú","som","si","sa","by","byť","čo","kto","ktorý","ktorá","ktoré",
     "ak","aké","ako","že","pre","pri","nad","pod","po","už","len","či","tiež",
     "slovenská","slovenska","sporiteľňa","sporitelna","slsp","sk"
-}
+})
+
+BUSINESS_HINTS = frozenset({"biznis","firma","firemny","firemný","podnik","podnikanie","živnost","zivnost","živnostník","zivnostnik"})
+
+# runs of 3+ alphanumerics (same as str.isalnum, i.e. \w without "_")
+_WORD_RE = re.compile(r"[^\W_]{3,}")
 
-BUSINESS_HINTS = {"biznis","firma","firemny","firemný","podnik","podnikanie","živnost","zivnost","živnostník","zivnostnik"}
+def _build_fold_table() -> Dict[int, int | str | None]:
+    """Map accented Latin letters to their base form and drop stray combining marks."""
+    table: Dict[int, int | str | None] = {cp: None for cp in range(0x0300, 0x0370)}
+    for lo, hi in ((0x00C0, 0x0250), (0x1E00, 0x1F00)):
+        for cp in range(lo, hi):
+            ch = chr(cp)
+            base = "".join(c for c in unicodedata.normalize("NFD", ch) if unicodedata.category(c) != "Mn")
+            if base != ch:
+                table[cp] = ord(base) if len(base) == 1 else base
+    return table
+
+_FOLD = str.maketrans(_build_fold_table())
 
 def strip_acc(s: str) -> str:
-    return "".join(ch for ch in unicodedata.normalize("NFD", s.lower())
-                   if unicodedata.category(ch) != "Mn")
+    return s.lower().translate(_FOLD)
 
 def tokens(s: str) -> List[str]:
-    s = strip_acc(s)
-    out, cur = [], []
-    for ch in s:
-        if ch.isalnum():
-            cur.append(ch)
-        else:
-            if cur:
-                out.append("".join(cur)); cur=[]
-    if cur: out.append("".join(cur))
-    return [t for t in out if len(t) >= 3 and t not in _SK_STOP]
-
-def cosine(a: np.ndarray, b: np.ndarray) -> float:
-    denom = (np.linalg.norm(a) * np.linalg.norm(b))
-    if denom == 0: return 0.0
-    return float(np.dot(a, b) / denom)
+    return [t for t in _WORD_RE.findall(strip_acc(s)) if t not in _SK_STOP]
 
-# ----------------- BM25 (lite) over chunks -----------------
+# ----------------- Query embedding cache -----------------
 
-def bm25_scores(q_toks: List[str], chunk_texts: List[List[str]], k1=1.2, b=0.75) -> List[float]:
-    if not chunk_texts or not q_toks:
-        return [0.0] * len(chunk_texts)
+@lru_cache(maxsize=1024)
+def _cached_query_embedding(model: str, query: str) -> bytes:
+    return np.asarray(embed_texts([query])[0], dtype=np.float32).tobytes()
+
+def query_embedding(query: str) -> np.ndarray:
+    """Embed a user query, reusing the result for repeated questions (UI retries etc.)."""
+    q = " ".join(query.split())
+    return np.frombuffer(_cached_query_embedding(settings.openai_embed_model, q), dtype=np.float32)
+
+# ----------------- Embedding matrix cache (SoA) -----------------
+
+# (ingest generation, max chunk id, chunk count) for a tenant; the generation is a
+# random token the DB gets on every ingest commit, so it also tells databases apart
+Version = Tuple[str, int, int]
 
+# tenant -> (version, chunk_ids[N], doc_ids[N], Q[N, D] int8, scales[N] float32)
+_matrix_cache: Dict[str, Tuple[Version, np.ndarray, np.ndarray, np.ndarray, np.ndarray]] = {}
+
+# rows dequantized per block when scoring, bounding the float32 scratch buffer
+_SCORE_BLOCK_ROWS = 4096
+
+def _quantize_rows(E: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric per-row int8 quantization (max |v| -> 127). The returned scale is
+    1 / ||q_row||, so scale * (q_row @ x) is the cosine against a unit vector x.
+    """
+    amax = np.abs(E).max(axis=1, keepdims=True) if E.size else np.ones((len(E), 1), dtype=np.float32)
+    amax[amax == 0] = 1.0
+    Q = np.rint(E * (127.0 / amax)).astype(np.int8)
+    norms = np.sqrt(np.einsum("ij,ij->i", Q, Q, dtype=np.float32))
+    scales = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    return Q, scales.astype(np.float32)
+
+def cosine_scores(Q: np.ndarray, scales: np.ndarray, q_hat: np.ndarray) -> np.ndarray:
+    """Cosine of every int8 row against the unit-norm query q_hat."""
+    sims = np.empty(len(Q), dtype=np.float32)
+    for start in range(0, len(Q), _SCORE_BLOCK_ROWS):
+        block = Q[start : start + _SCORE_BLOCK_ROWS]
+        sims[start : start + len(block)] = block.astype(np.float32) @ q_hat
+    sims *= scales
+    return sims
+
+_UNSAFE_FILENAME_RE = re.compile(r"[^0-9A-Za-z_-]")
+
+def _index_name(tenant: str) -> str:
+    safe = _UNSAFE_FILENAME_RE.sub("_", tenant)
+    if safe != tenant:
+        safe += "-" + hashlib.sha1(tenant.encode("utf-8")).hexdigest()[:8]
+    return safe
+
+def _index_tag_path(tenant: str) -> Path:
+    return Path(settings.index_dir) / f"{_index_name(tenant)}.version.json"
+
+def _index_paths(tenant: str, version: Version) -> Dict[str, Path]:
+    """
+    Array files of one matrix version. Files are named by version and never rewritten,
+    so swapping the tag file is the single step that publishes a new matrix.
+    """
+    key = hashlib.sha1(json.dumps(list(version)).encode("utf-8")).hexdigest()[:12]
+    base = Path(settings.index_dir)
+    name = _index_name(tenant)
+    return {
+        "embeddings": base / f"{name}.{key}.embeddings.npy",
+        "scales": base / f"{name}.{key}.scales.npy",
+        "ids": base / f"{name}.{key}.ids.npy",
+    }
+
+def _load_matrix_file(tenant: str, version: Version):
+    """Memory-map a persisted matrix if its version tag matches; None otherwise."""
+    try:
+        if tuple(json.loads(_index_tag_path(tenant).read_text())["version"]) != version:
+            return None
+        paths = _index_paths(tenant, version)
+        ids = np.load(paths["ids"])
+        Q = np.load(paths["embeddings"], mmap_mode="r")
+        scales = np.load(paths["scales"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if Q.dtype != np.int8:  # written by an older, float32 layout
+        return None
+    if not (ids.shape == (2, version[2]) and len(Q) == len(scales) == version[2]):
+        return None
+    return ids[0], ids[1], Q, scales
+
+def _save_matrix_file(tenant: str, version: Version, chunk_ids: np.ndarray, doc_ids: np.ndarray,
+                      Q: np.ndarray, scales: np.ndarray) -> None:
+    paths = _index_paths(tenant, version)
+    tag = _index_tag_path(tenant)
+    try:
+        tag.parent.mkdir(parents=True, exist_ok=True)
+        for key, arr in (("embeddings", Q), ("scales", scales), ("ids", np.stack([chunk_ids, doc_ids]))):
+            tmp = paths[key].with_name(paths[key].name + ".tmp")
+            with open(tmp, "wb") as f:
+                np.save(f, arr)
+            os.replace(tmp, paths[key])
+        # publish: readers see either the old complete set or the new one
+        tmp = tag.with_name(tag.name + ".tmp")
+        tmp.write_text(json.dumps({"version": list(version)}))
+        os.replace(tmp, tag)
+        # older sets; a reader that already mapped one keeps its open file
+        current = set(paths.values())
+        for old in tag.parent.glob(f"{_index_name(tenant)}.*.npy"):
+            if old not in current:
+                old.unlink(missing_ok=True)
+    except OSError:
+        logger.warning("Could not persist embedding matrix for tenant=%s", tenant, exc_info=True)
+
+# rows fetched (and quantized) per batch on a cold rebuild
+_BUILD_BATCH_ROWS = 2048
+
+def _build_matrix(db: Session, tenant: str, generation: str):
+    """
+    Stream the tenant's embeddings from the DB in batches, quantizing each batch
+    as it arrives; the full float32 matrix is never materialized.
+    """
+    result = db.execute(
+        select(Chunk.id, Chunk.document_id, Chunk.embedding)
+        .where(Chunk.tenant == tenant)
+        .execution_options(yield_per=_BUILD_BATCH_ROWS)
+    )
+    id_blocks, doc_blocks, q_blocks, scale_blocks = [], [], [], []
+    for part in result.partitions():
+        E = np.frombuffer(b"".join(row.embedding for row in part), dtype=np.float32).reshape(len(part), -1)
+        Q, scales = _quantize_rows(E)
+        id_blocks.append(np.fromiter((row.id for row in part), dtype=np.int64, count=len(part)))
+        doc_blocks.append(np.fromiter((row.document_id for row in part), dtype=np.int64, count=len(part)))
+        q_blocks.append(Q)
+        scale_blocks.append(scales)
+
+    if not id_blocks:
+        empty = np.empty(0, dtype=np.int64)
+        return (generation, 0, 0), empty, empty, np.empty((0, 0), dtype=np.int8), np.empty(0, dtype=np.float32)
+    chunk_ids = np.concatenate(id_blocks)
+    version = (generation, int(chunk_ids.max()), len(chunk_ids))
+    return version, chunk_ids, np.concatenate(doc_blocks), np.concatenate(q_blocks), np.concatenate(scale_blocks)
+
+def embedding_matrix(db: Session, tenant: str, rebuild: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Return (chunk_ids, doc_ids, Q, scales) for a tenant: one contiguous int8 matrix
+    of quantized embeddings plus per-row cosine scales (see cosine_scores()).
+    Rebuilt only when the tenant's chunks change; rebuilt matrices are persisted
+    under settings.index_dir and memory-mapped on reload. rebuild=True (used after
+    ingest) skips both caches and overwrites the persisted files.
+    """
+    # generation first: a commit landing in between only makes the version stale, never wrong
+    generation = db.scalar(select(IndexGeneration.generation).where(IndexGeneration.tenant == tenant)) or ""
+    max_id, count = db.execute(
+        select(func.max(Chunk.id), func.count(Chunk.id)).where(Chunk.tenant == tenant)
+    ).one()
+    version = (generation, max_id or 0, count)
+    cached = _matrix_cache.get(tenant)
+    if not rebuild and cached is not None and cached[0] == version:
+        return cached[1:]
+
+    # without a generation the DB gives no identity to check files against
+    loaded = _load_matrix_file(tenant, version) if count and generation and not rebuild else None
+    if loaded is not None:
+        cached = (version, *loaded)
+    else:
+        cached = _build_matrix(db, tenant, generation)
+        if cached[0][2] and generation:
+            _save_matrix_file(tenant, *cached)
+
+    _matrix_cache[tenant] = cached
+    return cached[1:]
+
+def _top_indices(scores: np.ndarray, m: int) -> np.ndarray:
+    """Indices of the m highest scores, best first: O(N) selection + O(m log m) sort."""
+    if m <= 0:
+        return np.empty(0, dtype=np.intp)
+    if m < len(scores):
+        idx = np.argpartition(-scores, m - 1)[:m]
+    else:
+        idx = np.arange(len(scores))
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+# ----------------- BM25 (lite) over chunks -----------------
+
+def bm25_scores(q_toks: List[str], chunk_texts: List[List[str]], k1=1.2, b=0.75) -> np.ndarray:
     N = len(chunk_texts)
-    df: Counter = Counter()
-    for toks in chunk_texts:
-        for t in set(toks):
-            df[t] += 1
-
-    idf: Dict[str, float] = {}
-    for t in set(q_toks):
-        n_t = df.get(t, 0)
-        # add-0.5 smoothing
-        idf[t] = math.log((N - n_t + 0.5) / (n_t + 0.5) + 1.0)
-
-    avgdl = sum(len(toks) for toks in chunk_texts) / max(1, N)
-    scores: List[float] = []
-    for toks in chunk_texts:
-        tf = Counter(toks)
-        dl = len(toks)
-        score = 0.0
-        for qt in q_toks:
-            if qt not in tf: 
-                continue
-            num = tf[qt] * (k1 + 1)
-            den = tf[qt] + k1 * (1 - b + b * dl / max(1.0, avgdl))
-            score += idf.get(qt, 0.0) * (num / den)
-        scores.append(score)
-    return scores
+    if not chunk_texts or not q_toks:
+        return np.zeros(N)
+
+    # term-frequency matrix restricted to query terms: tf[chunk, term]
+    terms = list(dict.fromkeys(q_toks))
+    tf = np.zeros((N, len(terms)))
+    for i, toks in enumerate(chunk_texts):
+        counts = Counter(toks)
+        tf[i] = [counts.get(t, 0) for t in terms]
+    dl = np.fromiter((len(toks) for toks in chunk_texts), dtype=np.float64, count=N)
+
+    df = np.count_nonzero(tf, axis=0)
+    # add-0.5 smoothing
+    idf = np.log((N - df + 0.5) / (df + 0.5) + 1.0)
+    # repeated query terms contribute once per occurrence
+    qtf = np.array([q_toks.count(t) for t in terms], dtype=np.float64)
+
+    avgdl = max(1.0, dl.sum() / N)
+    den = tf + k1 * (1 - b + b * dl[:, None] / avgdl)
+    return (tf * (k1 + 1) / den) @ (idf * qtf)
 
 # ----------------- Heuristic URL/title priors -----------------
 
+# (pattern, weight) path signals, applied at most once each per URL
+_URL_SIGNALS = [
+    # strong positive priors for consumer accounts hubs
+    (re.compile(r"/ludia/vsetky-ucty|/ludia/ucty"), 0.40),
+    (re.compile(r"/ludia/"), 0.15),
+    # penalize PDFs/assets/legal/archives/landing
+    (re.compile(r"/content/dam/|\.pdf$"), -0.40),
+    (re.compile(r"/zmluvne-podmienky|/archiv|/landing-pages/"), -0.25),
+]
+
 def url_title_prior(q_toks: List[str], url: str, title: str, is_business_query: bool) -> float:
     u = strip_acc(url)
     t = strip_acc(title or "")
@@ -94,17 +282,9 @@ def url_title_prior(q_toks: List[str], url: str, title: str, is_business_query:
     if "uct" in u or "uct" in t:
         prior += 0.35
 
-    # strong positive priors for consumer accounts hubs
-    if "/ludia/vsetky-ucty" in u or "/ludia/ucty" in u:
-        prior += 0.40
-    if "/ludia/" in u:
-        prior += 0.15
-
-    # penalize PDFs/assets/legal/archives/landing
-    if "/content/dam/" in u or u.endswith(".pdf"):
-        prior -= 0.40
-    if "/zmluvne-podmienky" in u or "/archiv" in u or "/landing-pages/" in u:
-        prior -= 0.25
+    for rx, weight in _URL_SIGNALS:
+        if rx.search(u):
+            prior += weight
 
     # business area handling
     if "/biznis/" in u:
@@ -121,71 +301,64 @@ def retrieve(db: Session, tenant: str, query: str, k: int | None = None):
       2) BM25 keyword score over chunk text
       3) URL/title priors (path heuristics)
       4) Aggregate to document level (best chunk wins)
-    Returns top-k chunks (one per document) scored by combined metric.
+    Returns top-k (chunk_id, text, doc_id, score, url, title) tuples, one per
+    document, scored by combined metric.
     """
     k = k or settings.top_k
-    q_vec = np.array(embed_texts([query])[0], dtype=np.float32)
+    q_vec = query_embedding(query)
     q_toks = tokens(query)
     is_business_query = any(t in BUSINESS_HINTS for t in q_toks)
 
-    # Load chunks
-    rows = db.execute(
-        select(Chunk.id, Chunk.text, Chunk.embedding, Chunk.document_id)
-        .where(Chunk.tenant == tenant)
-    ).all()
-    if not rows:
+    # Cosine preselect: blocked GEMV over the int8 matrix
+    chunk_ids, chunk_doc_ids, Q, scales = embedding_matrix(db, tenant)
+    if len(chunk_ids) == 0:
         return []
-
-    # Cosine preselect
-    cos_scored = []
-    for cid, text, emb_json, doc_id in rows:
-        emb = np.array(json.loads(emb_json), dtype=np.float32)
-        cos_scored.append((cid, text, doc_id, cosine(q_vec, emb)))
-
-    M = min(300, len(cos_scored))  # widen a bit
-    cos_scored.sort(key=lambda x: x[3], reverse=True)
-    prelim = cos_scored[:M]
-
-    # Prepare BM25 per chunk
-    prelim_text_tokens = [tokens(text) for (_, text, _, _) in prelim]
-    bm25 = bm25_scores(q_toks, prelim_text_tokens)
-
-    # Load documents for priors
-    doc_ids = list({doc_id for _, _, doc_id, _ in prelim})
-    doc_map = {
-        d.id: d
-        for d in db.execute(select(Document).where(Document.id.in_(doc_ids))).scalars()
+    q_norm = np.linalg.norm(q_vec)
+    if q_norm > 0:
+        q_vec = q_vec / q_norm
+    sims = cosine_scores(Q, scales, q_vec)
+
+    M = min(300, len(sims))  # widen a bit
+    top_idx = _top_indices(sims, M)
+
+    # Chunk text + document url/title for the preselected rows, in one joined query
+    meta = {
+        cid: (text, url or "", title or "")
+        for cid, text, url, title in db.execute(
+            select(Chunk.id, Chunk.text, Document.url, Document.title)
+            .join(Document, Chunk.document_id == Document.id)
+            .where(Chunk.id.in_(chunk_ids[top_idx].tolist()))
+        )
     }
-
-    # Combine scores per chunk
-    combined_per_chunk: List[Tuple[int, str, int, float]] = []
-    for (idx, (cid, text, doc_id, cos)) in enumerate(prelim):
-        d = doc_map.get(doc_id)
-        url = getattr(d, "url", "") or ""
-        title = getattr(d, "title", "") or ""
-
-        prior = url_title_prior(q_toks, url, title, is_business_query)
-        # weights: emphasize semantic (cosine) but allow keyword/priors to steer
-        final = 0.60 * cos + 0.25 * bm25[idx] + 0.15 * prior
-        combined_per_chunk.append((cid, text, doc_id, final))
-
-    # Aggregate to document: keep best chunk per document
-    best_per_doc: Dict[int, Tuple[int, str, int, float]] = {}
-    for cid, text, doc_id, score in combined_per_chunk:
-        if doc_id not in best_per_doc or score > best_per_doc[doc_id][3]:
-            best_per_doc[doc_id] = (cid, text, doc_id, score)
-
-    # Dedup by URL (sometimes same doc inserted multiple times)
-    by_url: Dict[str, Tuple[int, str, int, float]] = {}
-    for cid, text, doc_id, score in best_per_doc.values():
-        d = doc_map.get(doc_id)
-        url = getattr(d, "url", "")
-        prev = by_url.get(url)
-        if prev is None or score > prev[3]:
-            by_url[url] = (cid, text, doc_id, score)
-
-    ranked = list(by_url.values())
-    ranked.sort(key=lambda x: x[3], reverse=True)
+    # Per-prelim columns, aligned with top_idx
+    prelim_ids = chunk_ids[top_idx]
+    prelim_doc_ids = chunk_doc_ids[top_idx]
+    texts, urls, titles = zip(*(meta.get(int(cid), ("", "", "")) for cid in prelim_ids))
+
+    # BM25 keyword score over chunk text
+    bm25 = bm25_scores(q_toks, [tokens(text) for text in texts])
+
+    # URL/title prior depends only on the document, so compute it once per doc
+    priors: Dict[int, float] = {}
+    for doc_id, url, title in zip(prelim_doc_ids.tolist(), urls, titles):
+        if doc_id not in priors:
+            priors[doc_id] = url_title_prior(q_toks, url, title, is_business_query)
+    prior = np.array([priors[doc_id] for doc_id in prelim_doc_ids.tolist()])
+
+    # weights: emphasize semantic (cosine) but allow keyword/priors to steer
+    final = 0.60 * sims[top_idx].astype(np.float64) + 0.25 * bm25 + 0.15 * prior
+
+    # Best chunk per URL. This is also the best chunk per document (a document has
+    # one URL), and dedups URLs that were ingested as several documents.
+    _, url_codes = np.unique(np.array(urls), return_inverse=True)
+    order = np.lexsort((-final, url_codes))  # stable: earlier prelim rank wins ties
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = url_codes[order[1:]] != url_codes[order[:-1]]
+    best = order[first]
 
     # return top-k chunks (one per unique URL)
-    return ranked[:k]
+    top = best[_top_indices(final[best], min(k, len(best)))]
+    return [
+        (int(prelim_ids[i]), texts[i], int(prelim_doc_ids[i]), float(final[i]), urls[i], titles[i])
+        for i in top
+    ]
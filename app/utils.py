@@ -1,20 +1,42 @@
 import re
+from functools import lru_cache
+from typing import Iterator
 
 _token_re = re.compile(r"\w+|[^\w\s]")
+_ws_re = re.compile(r"\s*")
 
 def tokenize(txt: str) -> list[str]:
     return _token_re.findall(txt)
 
 
-def chunk_text(text: str, max_tokens: int = 900, overlap: int = 120) -> list[str]:
-    tokens = tokenize(text)
-    chunks = []
-    i = 0
-    while i < len(tokens):
-        window = tokens[i : i + max_tokens]
-        chunk = " ".join(window)
-        chunks.append(chunk)
-        if i + max_tokens >= len(tokens):
+@lru_cache(maxsize=16)
+def _skip_tokens_re(n: int) -> re.Pattern:
+    """Matches up to n tokens (with the whitespace before each), without building token strings."""
+    return re.compile(rf"(?:\s*(?:\w+|[^\w\s])){{0,{n}}}")
+
+
+def chunk_text(text: str, max_tokens: int = 900, overlap: int = 120) -> Iterator[str]:
+    """
+    Split text into windows of max_tokens tokens, consecutive windows sharing
+    overlap tokens. Windows are slices of the original text whose boundaries are
+    found by skipping N tokens inside the regex engine, so no per-token strings
+    are allocated and no window is re-joined. Windows are yielded lazily.
+    """
+    if len(text) <= max_tokens:
+        # every token is at least one character, so this is a single window
+        if window := text.strip():
+            yield window
+        return
+    # the stride is constant: a window is `step` tokens up to the next start plus
+    # `tail` (= overlap) tokens past it, so every token is scanned once per step
+    step = max(1, max_tokens - overlap)
+    step_re = _skip_tokens_re(step)
+    tail_re = _skip_tokens_re(max(0, max_tokens - step))
+    pos = _ws_re.match(text).end()
+    while pos < len(text):
+        nxt = step_re.match(text, pos).end()
+        end = tail_re.match(text, nxt).end()
+        yield text[pos:end]
+        if _token_re.search(text, end) is None:
             break
-        i += max_tokens - overlap
-    return chunks
\ No newline at end of file
+        pos = _ws_re.match(text, nxt).end()
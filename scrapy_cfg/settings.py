@@ -2,20 +2,19 @@ BOT_NAME = "ivesna_bot"
 ROBOTSTXT_OBEY = True
 LOG_ENABLED = False
 
-# Use Playwright for HTTP(S)
+# Playwright handles https; only requests with meta["playwright"] (JS hosts, see
+# IVESNA_JS_DOMAINS) open a browser page, the rest go through the plain HTTP downloader
 DOWNLOAD_HANDLERS = {
-    "http": "scrapy_playwright.handler.ScrapyPlaywrightDownloadHandler",
     "https": "scrapy_playwright.handler.ScrapyPlaywrightDownloadHandler",
 }
 
 TWISTED_REACTOR = "twisted.internet.asyncioreactor.AsyncioSelectorReactor"
 
-# Politeness / timeouts
+# Politeness / timeouts (per-tenant throttling lives in SiteCrawler.custom_settings)
 DOWNLOAD_TIMEOUT = 25
-CONCURRENT_REQUESTS = 8
-AUTOTHROTTLE_ENABLED = True
-AUTOTHROTTLE_START_DELAY = 0.25
-AUTOTHROTTLE_MAX_DELAY = 3.0
+CONCURRENT_REQUESTS = 32
+CONCURRENT_REQUESTS_PER_DOMAIN = 4
 
 PLAYWRIGHT_BROWSER_TYPE = "chromium"
+PLAYWRIGHT_MAX_CONTEXTS = 4  # reuse browser contexts across pages
 PLAYWRIGHT_DEFAULT_NAVIGATION_TIMEOUT = 20000  # ms
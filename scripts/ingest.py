@@ -1,23 +1,39 @@
 #!/usr/bin/env python
 import argparse
+import itertools
 import sys
 from pathlib import Path
+from typing import Iterator
+from urllib.parse import urlsplit, urlunsplit
 import os
 from dotenv import load_dotenv
 
-from app.db import SessionLocal, init_db
-from app.ingest_lib import process_pages
-from app.crawler import crawl_urls_blocking, allowed
+from app.db import init_db
+from app.ingest_lib import stream_pages_to_db
+from app.crawler import crawl_urls_blocking, allowed, allow_domains, compile_allow
 
 # Load .env from project root
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "..", ".env"))
 
-def read_urls_from_file(path: str) -> list[str]:
+def read_urls_from_file(path: str) -> Iterator[str]:
+    """
+    Yield URLs line by line, skipping blanks and '#' comments; the file is never held
+    in memory and only kept lines are decoded.
+    """
     p = Path(path)
     if not p.exists():
         print(f"File not found: {path}", file=sys.stderr)
         sys.exit(1)
-    return [line.strip() for line in p.read_text(encoding="utf-8").splitlines() if line.strip() and not line.startswith('#')]
+    with p.open("rb") as f:
+        for line in f:
+            s = line.strip()
+            if s and not s.startswith(b'#'):
+                yield s.decode("utf-8")
+
+def _norm_url(u: str) -> str:
+    """Canonical seed form: lowercase scheme/host, '/' for an empty path, no #fragment."""
+    s = urlsplit(u.strip())
+    return urlunsplit((s.scheme.lower(), s.netloc.lower(), s.path or "/", s.query, ""))
 
 
 def main():
@@ -31,26 +47,33 @@ def main():
     parser.add_argument("--ignore-robots", action="store_true", help="Ignore robots.txt (use only with permission)")
     args = parser.parse_args()
 
-    urls = args.urls or []
-    if args.file:
-        urls += read_urls_from_file(args.file)
-
+    # normalize + dedupe in one order-preserving pass, then filter
+    seeds = itertools.chain(args.urls, read_urls_from_file(args.file) if args.file else ())
+    urls = dict.fromkeys(_norm_url(u) for u in seeds)
     urls = [u for u in urls if allowed(u)]
     if not urls:
         print("No allowed URLs provided.")
         sys.exit(0)
 
+    # compile --allow once; the crawler and sitemap seeding reuse the patterns as-is
+    allow_rx = compile_allow(args.allow, allow_domains(urls))
+
     init_db()
-    with SessionLocal() as db:
+    # pages are chunked/embedded/stored while the crawl is still running
+    feed, finish = stream_pages_to_db(args.tenant, total=args.max_pages)
+    try:
         pages = crawl_urls_blocking(
             urls, 
             max_pages=args.max_pages, 
             max_depth=args.max_depth,
-            allow_patterns=args.allow,
-            ignore_robots=args.ignore_robots
+            allow_patterns=allow_rx,
+            ignore_robots=args.ignore_robots,
+            on_page=feed,
+            tenant=args.tenant,
         )
-        stored = process_pages(db, args.tenant, pages)
-        print(f"Crawled {len(pages)} page(s), stored {stored} document(s).")
+    finally:
+        stored = finish()
+    print(f"Crawled {len(pages)} page(s), stored {stored} document(s).")
 
 
 if __name__ == "__main__":